@@ -16,9 +16,13 @@
 
 import requests
 import datetime
+import http.cookiejar
+import queue
 import socket
+import threading
 import time
 import urllib.parse
+import urllib3
 
 import sling
 import sling.net
@@ -74,6 +78,32 @@ def ts2rfc(t):
 # Connect to case database.
 casedb = sling.Database(flags.arg.casedb, "case.py")
 
+# Updates to shared cases are written to the case database by a background
+# writer thread, so share requests do not have to wait for the database. The
+# updates are applied in the order they were received.
+casedb_updates = queue.Queue(1024)
+
+def casedb_writer():
+  while True:
+    caseid, data, ts, client = casedb_updates.get()
+    try:
+      key = str(caseid)
+      if data is not None:
+        # Store case in database.
+        casedb.put(key, data, version=ts)
+      elif key in casedb:
+        # Delete case from database.
+        casedb.delete(key)
+
+        # Log case delete with IP address.
+        log.info("Unshare case #%d version %d for client %s" %
+                 (caseid, ts, client))
+    except Exception as e:
+      log.error("Error updating case #%d: %s" % (caseid, e))
+    casedb_updates.task_done()
+
+threading.Thread(target=casedb_writer, daemon=True).start()
+
 # Initialize HTTP server.
 app = sling.net.HTTPServer(flags.arg.port)
 app.redirect("/", "/c")
@@ -109,9 +139,8 @@ main_page_template = """<!DOCTYPE html>
 </body>
 </html>""";
 
-@app.route("/c")
-def main_page(request):
-  return main_page_template
+# The main page is static, so it is encoded once and served as-is.
+app.page("/c", main_page_template.encode("utf-8"))
 
 @app.route("/case/new")
 def new_case(request):
@@ -174,19 +203,14 @@ def share_case(request):
 
   # Share or unshare.
   if casefile[n_share]:
-    # Store case in database.
-    casedb.put(str(caseid), request.body, version=ts)
+    # Queue case for storing in database.
+    casedb_updates.put((caseid, request.body, ts, client))
 
     # Log case updates with IP address.
     log.info("Share case #%d version %d for client %s" % (caseid, ts, client))
   else:
-    # Delete case from database.
-    key = str(caseid)
-    if key in casedb:
-      casedb.delete(key)
-      # Log case delete with IP address.
-      log.info("Unshare case #%d version %d for client %s" %
-               (caseid, ts, client))
+    # Queue case for deletion from database.
+    casedb_updates.put((caseid, None, ts, client))
 
 @app.route("/case/service")
 def service_request(request):
@@ -209,6 +233,18 @@ non_proxy_headers = set([
 
 checked_hostnames = set()
 
+# HTTP session with connection pooling for proxy requests. The session is
+# shared by all clients, so cookies from responses are not retained.
+proxy_session = requests.Session()
+proxy_session.cookies.set_policy(
+  http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+proxy_adapter = requests.adapters.HTTPAdapter(
+  pool_connections=8,
+  pool_maxsize=8,
+  max_retries=urllib3.util.Retry(total=2, backoff_factor=0.1))
+proxy_session.mount("https://", proxy_adapter)
+proxy_session.mount("http://", proxy_adapter)
+
 @app.route("/case/proxy")
 def service_request(request):
   # Get URL.
@@ -236,7 +272,7 @@ def service_request(request):
 
   # Forward request.
   log.info("Proxy request for", url, headers, cookies)
-  r = requests.get(url, headers=headers, cookies=cookies)
+  r = proxy_session.get(url, headers=headers, cookies=cookies)
 
   # Relay back response.
   response = sling.net.HTTPResponse()
@@ -285,5 +321,8 @@ services.init()
 # Run HTTP server.
 log.info("HTTP server listening on port", flags.arg.port)
 app.run()
+
+# Write pending case updates to database.
+casedb_updates.join()
 log.info("Shutdown.")
 
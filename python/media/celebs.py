@@ -271,7 +271,6 @@ for id, version, value in redditdb(chkpt.checkpoint):
     profile = photo.Profile(key)
     n = profile.add_media(url, None, nsfw)
     if n > 0:
-      photo.store.coalesce()
       profile.write()
 
 # Cleanup
@@ -14,6 +14,7 @@
 
 """Photo profile library."""
 
+import concurrent.futures
 import hashlib
 import json
 import os
@@ -23,6 +24,12 @@ import ssl
 import urllib.parse
 import urllib3
 
+# Use simdjson for decoding API replies if it is installed.
+try:
+  import simdjson as fastjson
+except ImportError:
+  fastjson = json
+
 import sling
 import sling.flags as flags
 
@@ -85,6 +92,10 @@ db = None
 # Media database.
 mediadb = None
 
+# Thread pool and cache for prefetching HEAD responses.
+head_executor = None
+head_cache = {}
+
 # Session for fetching image data. Disable SSL checking.
 class TLSAdapter(requests.adapters.HTTPAdapter):
   def init_poolmanager(self, *args, **kwargs):
@@ -97,36 +108,201 @@ class TLSAdapter(requests.adapters.HTTPAdapter):
 
 session = requests.Session()
 session.verify = False
-session.mount('https://', TLSAdapter())
+session.mount('https://', TLSAdapter(
+  pool_connections=32,
+  pool_maxsize=32,
+  max_retries=urllib3.util.Retry(total=3, backoff_factor=0.3)))
 urllib3.disable_warnings()
 
+# Session for Imgur and Reddit API calls with certificate checking.
+apisession = requests.Session()
+apisession.mount('https://', requests.adapters.HTTPAdapter(
+  pool_connections=4,
+  pool_maxsize=4,
+  max_retries=urllib3.util.Retry(total=3, backoff_factor=0.3)))
+
 # Fingerprints for bad photos.
 bad_photos = set([
   b'\xf1{\x01\x90\x1cu,\x1b\xb0I(\x13\x1d\x16a\xaf', # i.reddit.it
   b'\xd85\x88Cs\xf4\xd6\xc8\xf2GB\xce\xab\xe7IF',    # i.imgur.com/removed.png
 ])
 
-# Global store.
-store = sling.Store()
-n_media = store["media"]
-n_is = store["is"]
-n_legend = store["P2096"]
-n_stated_in = store["P248"]
-n_has_quality = store["P1552"]
-n_nsfw = store["Q2716583"]
+# Global store with symbols.
+commons = sling.Store()
+n_media = commons["media"]
+n_is = commons["is"]
+n_legend = commons["P2096"]
+n_stated_in = commons["P248"]
+n_has_quality = commons["P1552"]
+n_nsfw = commons["Q2716583"]
+commons.freeze()
 
 # Get API keys for Imgur.
 imgurkeys = None
+imgurauth = None
 if os.path.exists("local/keys/imgur.json"):
   with open("local/keys/imgur.json", "r") as f:
     imgurkeys = json.load(f)
+  imgurauth = {'Authorization': "Client-ID " + imgurkeys["clientid"]}
+
+# API endpoints.
+imgur_album_api = "https://api.imgur.com/3/album/"
+imgur_image_api = "https://api.imgur.com/3/image/"
+reddit_info_api = "https://api.reddit.com/api/info/?id=t3_"
+reddit_headers = {"User-agent": "SLING Bot 1.0"}
+
+# URL patterns.
+host_alias_pat = re.compile(r"/(?:(?:i|www|m)\.(?=imgur\.com/)|"
+                            r"(?:www|old)\.(?=reddit\.com/))")
+insecure_prefixes = ("http://reddit.com", "http://imgur.com")
+imgur_jpeg_pat = re.compile(r"(https://imgur\.com/.+)\.jpeg")
+query_suffix_pat = re.compile(r"(https://imgur\.com/.+|"
+                              r"https?://reddit\.com/.+|"
+                              r"https?://i\.redd\.it/.+|"
+                              r"https?://i\.redditmedia\.com/.+)[\?#].*")
+imgur_image_suffix_pat = re.compile(r"(https://imgur\.com/.+\.jpe?g)-\w+")
+reddit_png_preview_pat = re.compile(r"https://preview.redd.it/(\w+.png)\?.+")
+reddit_preview_pat = re.compile(r"https://preview.redd.it/(\w+.(?:png|jpg))\?")
+reddit_gallery_preview_pat = re.compile(r"https://preview.redd.it/(\w+\.\w+)\?")
+dr_image_scaler_pat = re.compile(
+  r"https://asset.dr.dk/[Ii]mage[Ss]caler/\?(.+)")
+selftext_album_pat = re.compile(
+  r"\[([^\]\n]{1,200})\]\((https?://imgur\.com/a/\w+)\)")
+numbering_pat = re.compile(r"(.+) \(\d+/\d+\)")
+word_pat = re.compile(r"\w+")
+
+# Video urls.
+video_suffixes = (".gif", ".gifv", ".mp4", ".webm")
+video_prefixes = (
+  "https://gfycat.com/",
+  "https://redgifs.com/",
+  "https://v.redd.it/",
+)
+
+# Split https url into host and path segments, discarding query and fragment.
+# The url is split on the literal delimiters, so the segments correspond
+# exactly to the url text. Returns None as host for other urls.
+def split_url(url):
+  if not url.startswith("https://"): return None, None
+  host, slash, path = url[8:].partition("/")
+  if not slash: return None, None
+  path = path.partition("?")[0].partition("#")[0]
+  return host, ("/" + path).split("/")
+
+# Get identifier from the leading word characters of a url path segment.
+def segment_id(segs, index):
+  if index >= len(segs): return None
+  m = word_pat.match(segs[index])
+  if m == None: return None
+  return m.group(0)
+
+# Check if url path segment only consists of word characters.
+def is_word(segs, index):
+  return index < len(segs) and word_pat.fullmatch(segs[index]) != None
 
 # Trim numbering from caption.
 def trim_numbering(caption):
-  m = re.fullmatch("(.+) \(\d+/\d+\)", caption)
+  m = numbering_pat.fullmatch(caption)
   if m != None: return m.group(1)
   return caption
 
+# Normalize media url.
+def trim_url(url):
+  url = host_alias_pat.sub("/", url)
+
+  m = imgur_jpeg_pat.match(url)
+  if m != None: url = m.group(1) + ".jpg"
+
+  if url.startswith(insecure_prefixes): url = "https" + url[4:]
+
+  m = query_suffix_pat.match(url)
+  if m != None:
+    url = m.group(1)
+    if url.endswith("/new"): url = url[:-4]
+
+  m = reddit_png_preview_pat.match(url)
+  if m != None: url = "https://i.redd.it/" + m.group(1)
+
+  m = imgur_image_suffix_pat.match(url)
+  if m != None: url = m.group(1)
+
+  return url
+
+# Classify media url. Returns the kind of media and the trimmed url or the
+# id of the album, image, or posting. The kind is "video", "imgur_album",
+# "imgur_image", "reddit_gallery", "photo", or None for empty urls.
+def classify_media(url, video=False):
+  # Trim url.
+  url = trim_url(url)
+
+  # Discard videos.
+  if not video:
+    if url.endswith(video_suffixes) or url.startswith(video_prefixes):
+      return "video", url
+
+  # Discard empty urls.
+  if len(url) == 0: return None, None
+
+  # Dispatch albums, galleries, and postings on host and path.
+  host, segs = split_url(url)
+  if host == "imgur.com":
+    kind = segs[1]
+    if kind == "a" or kind == "gallery":
+      # Imgur album or gallery.
+      albumid = segment_id(segs, 2)
+      if albumid != None: return "imgur_album", albumid
+    if len(kind) == 1 and is_word(segs, 1) and is_word(segs, 2):
+      # Imgur tag gallery.
+      galleryid = segment_id(segs, 3)
+      if galleryid != None: return "imgur_album", galleryid
+    imageid = url[18:]
+    if imageid.endswith("\n"): imageid = imageid[:-1]
+    if word_pat.fullmatch(imageid) != None:
+      # Single-image imgur.
+      return "imgur_image", imageid
+  elif host == "reddit.com":
+    if segs[1] == "gallery":
+      # Reddit gallery.
+      galleryid = segment_id(segs, 2)
+      if galleryid != None: return "reddit_gallery", galleryid
+    if len(segs) > 5 and segs[3] == "comments" and \
+       is_word(segs, 1) and is_word(segs, 2) and is_word(segs, 4):
+      # Reddit posting.
+      return "reddit_gallery", segs[4]
+
+  # Reddit preview.
+  m = reddit_preview_pat.match(url)
+  if m != None:
+    imagename = m.group(1)
+    url = "https://i.redd.it/" + imagename
+
+  # DR image scaler.
+  m = dr_image_scaler_pat.match(url)
+  if m != None:
+    q = urllib.parse.parse_qs(m.group(1))
+    url = "https://%s/%s" % (q["server"][0], q["file"][0])
+
+  return "photo", url
+
+# Get alternative imgur url for photo.
+def alt_url(url):
+  if url.startswith("https://imgur.com/"):
+    return "https://i.imgur.com/" + url[18:]
+  elif url.startswith("https://i.imgur.com/"):
+    return "https://imgur.com/" + url[20:]
+  return None
+
+# Fetch HEAD responses for photo urls in parallel. The responses are cached
+# and consumed by add_photo when checking photos.
+def prefetch_heads(urls):
+  global head_executor
+  if head_executor is None:
+    head_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+  urls = [url for url in set(urls) if url not in head_cache]
+  futures = [head_executor.submit(session.head, url) for url in urls]
+  for url, future in zip(urls, futures):
+    if future.exception() is None: head_cache[url] = future.result()
+
 def photodb():
   global db
   if db is None: db = sling.Database(flags.arg.photodb, "photo.py")
@@ -139,30 +315,48 @@ class Profile:
     self.isnew = False
     self.skipdups = True
     self.captionless = flags.arg.captionless
+    self.check = flags.arg.check
+    self.video = flags.arg.video
+    self.albums = flags.arg.albums
+    self.perimagecaption = flags.arg.perimagecaption
+    self.numbering = flags.arg.numbering
+    self.fixedcaption = flags.arg.fixedcaption
+    self.source = flags.arg.source
+    self.urls = None
+    self.store = sling.Store(commons)
+    self.api_replies = {}
     if itemid is None:
       data = None
     else:
       data, _ = photodb().get(itemid)
     if data is None:
-      self.frame = store.frame({})
+      self.frame = self.store.frame({})
       self.isnew = True
     else:
-      self.frame = store.parse(data)
+      self.frame = self.store.parse(data)
+    self.num_media = self.frame.count(n_media)
+
+  # Serialize photo profile.
+  def data(self):
+    self.store.coalesce()
+    return self.frame.data(binary=True)
 
   # Write photo profile to database.
   def write(self):
     if self.itemid is None or self.itemid == "": raise Error("empty id")
-    data = self.frame.data(binary=True)
+    data = self.data()
     result = photodb().put(self.itemid, data)
     if result == sling.DBUNCHANGED: print(self.itemid, "unchanged")
 
   # Clear all photos.
   def clear(self):
     del self.frame[n_media]
+    self.urls = None
+    self.num_media = 0
 
   # Return number of photos in profile.
   def count(self):
-    return self.frame.count(n_media)
+    return self.num_media
 
   # Return iterator over all photos.
   def media(self):
@@ -199,13 +393,18 @@ class Profile:
     for photo in photos: slots.append((n_media, photo))
     del self.frame[n_media]
     self.frame.extend(slots)
+    self.urls = None
+    self.num_media = len(slots)
 
   # Check if photo already in profile.
   def has(self, url, alturl=None):
-    for media in self.media():
-      if type(media) is sling.Frame: media = media[n_is]
-      if media == url or media == alturl: return True
-    return False
+    if self.urls is None:
+      # Build set of photo urls in profile on first check.
+      self.urls = set()
+      for media in self.media():
+        if type(media) is sling.Frame: media = media[n_is]
+        self.urls.add(media)
+    return url in self.urls or (alturl != None and alturl in self.urls)
 
   # Add photo to profile.
   def add_photo(self, url, caption=None, source=None, nsfw=False):
@@ -215,8 +414,9 @@ class Profile:
       return 0
 
     # Check if photo exists.
-    if flags.arg.check:
-      r = session.head(url)
+    if self.check:
+      r = head_cache.pop(url, None)
+      if r is None: r = session.head(url)
       if r.status_code // 100 == 3:
         redirect = r.headers['Location']
         if redirect.endswith("/removed.png"):
@@ -249,12 +449,7 @@ class Profile:
         return 0
 
     # Check if photo is already in the profile.
-    alturl = None
-    if url.startswith("https://imgur.com/"):
-      alturl = "https://i.imgur.com/" + url[18:]
-    elif url.startswith("https://i.imgur.com/"):
-      alturl = "https://imgur.com/" + url[20:]
-    if self.skipdups and self.has(url, alturl):
+    if self.skipdups and self.has(url, alt_url(url)):
       print("Skip existing photo", url)
       return 0
 
@@ -264,30 +459,35 @@ class Profile:
 
     # Add media to profile.
     slots = [(n_is, url)]
-    if flags.arg.fixedcaption: caption = flags.arg.fixedcaption
+    if self.fixedcaption: caption = self.fixedcaption
     if caption and not self.captionless: slots.append((n_legend, caption))
-    if source: slots.append((n_stated_in, store[source]))
+    if source: slots.append((n_stated_in, self.store[source]))
     if nsfw: slots.append((n_has_quality, n_nsfw))
     if len(slots) == 1:
       self.frame.append(n_media, url)
     else:
-      self.frame.append(n_media, store.frame(slots))
+      self.frame.append(n_media, self.store.frame(slots))
+    if self.urls != None: self.urls.add(url)
+    self.num_media += 1
 
     return 1
 
   # Add Imgur album.
   def add_imgur_album(self, albumid, caption, isnsfw=False):
     print("Imgur album", albumid)
-    auth = {'Authorization': "Client-ID " + imgurkeys["clientid"]}
-    r = session.get("https://api.imgur.com/3/album/" + albumid, headers=auth)
-    if r.status_code == 404:
-      print("Skipping missing album", albumid)
-      return 0
-    if r.status_code == 403:
-      print("Skipping unaccessible album", albumid)
-      return 0
-    r.raise_for_status()
-    reply = r.json()["data"]
+    url = imgur_album_api + albumid
+    reply = self.api_replies.get(url)
+    if reply is None:
+      r = apisession.get(url, headers=imgurauth)
+      if r.status_code == 404:
+        print("Skipping missing album", albumid)
+        return 0
+      if r.status_code == 403:
+        print("Skipping unaccessible album", albumid)
+        return 0
+      r.raise_for_status()
+      reply = fastjson.loads(r.content)["data"]
+      self.api_replies[url] = reply
     #print(json.dumps(reply, indent=2))
 
     serial = 1
@@ -298,21 +498,32 @@ class Profile:
     elif caption is not None and caption.startswith(album_title):
       album_title = caption
 
-    count = 0
+    # Remove query parameters from image links.
+    links = []
     for image in reply["images"]:
       link = image["link"]
-
-      # Remove query parameters.
       qs = link.find("?")
       if qs != -1: link = link[:qs]
+      links.append(link)
+    if self.check:
+      # Prefetch HEAD responses for new photos in album.
+      urls = []
+      for image, link in zip(reply["images"], links):
+        if not self.video and image["animated"]: continue
+        if self.has(link, alt_url(link)): continue
+        urls.append(link)
+      prefetch_heads(urls)
+
+    count = 0
+    for image, link in zip(reply["images"], links):
 
       # Skip anmated GIFs.
-      if (not flags.arg.video and image["animated"]):
+      if (not self.video and image["animated"]):
         print("Skipping animated image", link);
         continue
 
       # Image caption.
-      if flags.arg.perimagecaption:
+      if self.perimagecaption:
         title = image["title"]
         if title is None:
           title = image["description"]
@@ -320,7 +531,7 @@ class Profile:
         title = None
 
       if title is None and album_title != None:
-        if flags.arg.numbering:
+        if self.numbering:
           title = album_title + " (%d/%d)" % (serial, total)
         else:
           title = album_title
@@ -333,18 +544,24 @@ class Profile:
       # Add media frame to profile.
       if self.add_photo(link, title, None, nsfw): count += 1
       serial += 1
+
+    # Drop prefetched responses that were not used.
+    for link in links: head_cache.pop(link, None)
     return count
 
   # Add Imgur image.
   def add_imgur_image(self, imageid, isnsfw=False):
     print("Imgur image", imageid)
-    auth = {'Authorization': "Client-ID " + imgurkeys["clientid"]}
-    r = session.get("https://api.imgur.com/3/image/" + imageid, headers=auth)
-    if r.status_code == 404:
-      print("Skipping missing image", imageid)
-      return 0
-    r.raise_for_status()
-    reply = r.json()["data"]
+    url = imgur_image_api + imageid
+    reply = self.api_replies.get(url)
+    if reply is None:
+      r = apisession.get(url, headers=imgurauth)
+      if r.status_code == 404:
+        print("Skipping missing image", imageid)
+        return 0
+      r.raise_for_status()
+      reply = fastjson.loads(r.content)["data"]
+      self.api_replies[url] = reply
     #print(json.dumps(reply, indent=2))
 
     # Photo URL.
@@ -353,7 +570,7 @@ class Profile:
     if qs != -1: link = link[:qs]
 
     # Skip anmated GIFs.
-    if (not flags.arg.video and reply["animated"]):
+    if (not self.video and reply["animated"]):
       print("Skipping animated image", link);
       return 0
 
@@ -373,17 +590,20 @@ class Profile:
   # Add Reddit gallery.
   def add_reddit_gallery(self, galleryid, caption, isnsfw=False):
     print("Redit posting", galleryid)
-    r = requests.get("https://api.reddit.com/api/info/?id=t3_" + galleryid,
-                     headers = {"User-agent": "SLING Bot 1.0"})
-    r.raise_for_status()
-    children = r.json()["data"]["children"]
+    url = reddit_info_api + galleryid
+    children = self.api_replies.get(url)
+    if children is None:
+      r = apisession.get(url, headers=reddit_headers)
+      r.raise_for_status()
+      children = fastjson.loads(r.content)["data"]["children"]
+      self.api_replies[url] = children
     if len(children) == 0:
       print("Skipping empty post", galleryid);
       return 0
     reply = children[0]["data"]
     #print(json.dumps(reply, indent=2))
 
-    if not flags.arg.albums and reply["is_self"]:
+    if not self.albums and reply["is_self"]:
       print("Skipping self post", galleryid);
       return 0
     if reply["removed_by_category"] != None:
@@ -407,10 +627,10 @@ class Profile:
       nsfw = isnsfw or reply["over_18"]
 
       count = 0
-      if flags.arg.albums:
+      if self.albums:
         # Fetch albums from text.
         selftext = reply["selftext"]
-        for m in re.finditer("\[(.+)\]\((https?://imgur.com/a/\w+)\)", selftext):
+        for m in selftext_album_pat.finditer(selftext):
           print("Album", m[2], m[1])
           count += self.add_media(m[2], m[1], nsfw)
       else:
@@ -442,7 +662,7 @@ class Profile:
         print("Skipping missing image in gallery", mediaid);
         continue
 
-      m = re.match("https://preview.redd.it/(\w+\.\w+)\?", link)
+      m = reddit_gallery_preview_pat.match(link)
       if m != None: link = "https://i.redd.it/" + m.group(1)
 
       # Image caption.
@@ -453,7 +673,7 @@ class Profile:
         title = caption
       if self.captionless: title = None
 
-      if title != None and flags.arg.numbering:
+      if title != None and self.numbering:
         title = "%s (%d/%d)" % (title, serial, len(items))
 
       # NSFW flag.
@@ -466,101 +686,19 @@ class Profile:
 
   # Add media.
   def add_media(self, url, caption, nsfw):
-    # Trim url.
-    url = url.replace("/i.imgur.com/", "/imgur.com/")
-    url = url.replace("/www.imgur.com/", "/imgur.com/")
-    url = url.replace("/m.imgur.com/", "/imgur.com/")
-
-    m = re.match("(https://imgur\.com/.+)\.jpeg", url)
-    if m != None: url = m.group(1) + ".jpg"
-
-    url = url.replace("/www.reddit.com/", "/reddit.com/")
-    url = url.replace("/old.reddit.com/", "/reddit.com/")
-
-    if url.startswith("http://reddit.com"): url = "https" + url[4:]
-    if url.startswith("http://imgur.com"): url = "https" + url[4:]
-
-    m = re.match("(https://imgur\.com/.+)[\?#].*", url)
-    if m == None: m = re.match("(https?://reddit\.com/.+)[\?#].*", url)
-    if m == None: m = re.match("(https?://i\.redd\.it/.+)[\?#].*", url)
-    if m == None: m = re.match("(https?://i\.redditmedia\.com/.+)[\?#].*", url)
-    if m != None:
-      url = m.group(1)
-      if url.endswith("/new"): url = url[:-4]
-
-    m = re.match("https://preview.redd.it/(\w+.png)\?.+", url)
-    if m != None: url = "https://i.redd.it/" + m.group(1)
-
-    m = re.match("(https://imgur\.com/.+\.jpe?g)-\w+", url)
-    if m != None: url = m.group(1)
-
-    # Discard videos.
-    if not flags.arg.video:
-      if url.endswith(".gif") or \
-         url.endswith(".gifv") or \
-         url.endswith(".mp4") or \
-         url.endswith(".webm") or \
-         url.startswith("https://gfycat.com/") or \
-         url.startswith("https://redgifs.com/") or \
-         url.startswith("https://v.redd.it/"):
-        print("Skipping video", url)
-        return 0
-
-    # Discard empty urls.
-    if len(url) == 0: return 0
-
-    # Imgur album.
-    m = re.match("https://imgur\.com/a/(\w+)", url)
-    if m != None:
-      albumid = m.group(1)
-      return self.add_imgur_album(albumid, caption, nsfw)
-
-    # Imgur gallery.
-    m = re.match("https://imgur\.com/gallery/(\w+)", url)
-    if m != None:
-      galleryid = m.group(1)
-      return  self.add_imgur_album(galleryid, caption, nsfw)
-    m = re.match("https?://imgur\.com/\w/\w+/(\w+)", url)
-    if m != None:
-      galleryid = m.group(1)
-      return  self.add_imgur_album(galleryid, caption, nsfw)
-
-    # Single-image imgur.
-    m = re.match("https://imgur\.com/(\w+)$", url)
-    if m != None:
-      imageid = m.group(1)
-      return self.add_imgur_image(imageid, nsfw)
-
-    # Reddit gallery.
-    m = re.match("https://reddit\.com/gallery/(\w+)", url)
-    if m != None:
-      galleryid = m.group(1)
-      return self.add_reddit_gallery(galleryid, caption, nsfw)
-
-    # Reddit posting.
-    m = re.match("https://(www\.)?reddit\.com/\w+/\w+/comments/(\w+)/", url)
-    if m != None:
-      galleryid = m.group(2)
-      return self.add_reddit_gallery(galleryid, caption, nsfw)
-
-    # Reddit preview.
-    m = re.match("https://preview.redd.it/(\w+.png)\?", url)
-    if m != None:
-      imagename = m.group(1)
-      url = "https://i.redd.it/" + imagename
-    m = re.match("https://preview.redd.it/(\w+.jpg)\?", url)
-    if m != None:
-      imagename = m.group(1)
-      url = "https://i.redd.it/" + imagename
-
-    # DR image scaler.
-    m = re.match("https://asset.dr.dk/[Ii]mage[Ss]caler/\?(.+)", url)
-    if m != None:
-      q = urllib.parse.parse_qs(m.group(1))
-      url = "https://%s/%s" % (q["server"][0], q["file"][0])
-
-    # Add media to profile.
-    return self.add_photo(url, caption, flags.arg.source, nsfw)
+    kind, key = classify_media(url, self.video)
+    if kind == "video":
+      print("Skipping video", key)
+      return 0
+    elif kind == "imgur_album":
+      return self.add_imgur_album(key, caption, nsfw)
+    elif kind == "imgur_image":
+      return self.add_imgur_image(key, nsfw)
+    elif kind == "reddit_gallery":
+      return self.add_reddit_gallery(key, caption, nsfw)
+    elif kind == "photo":
+      return self.add_photo(key, caption, self.source, nsfw)
+    return 0
 
   def dedup(self):
     # Connect to media database.
@@ -577,7 +715,7 @@ class Profile:
     num_duplicates = 0
     num_missing = 0
     for media in self.media():
-      url = store.resolve(media)
+      url = self.store.resolve(media)
       nsfw = type(media) is sling.Frame and media[n_has_quality] == n_nsfw
       captioned = type(media) is sling.Frame and n_legend in media
       if captioned: captions[url] = media[n_legend]
@@ -649,7 +787,7 @@ class Profile:
       # Find photos to keep.
       keep = []
       for media in self.media():
-        url = store.resolve(media)
+        url = self.store.resolve(media)
         if url not in duplicates and url not in missing: keep.append(media)
       self.replace(keep)
 
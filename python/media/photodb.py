@@ -104,31 +104,58 @@ if flags.arg.exclude != None:
   for url in flags.arg.exclude:
     excluded.add(url[0])
 
+# Write batch of serialized profiles to database and clear the batch.
+write_batch_size = 256
+
+def write_profiles(records):
+  if len(records) == 0: return
+  results = photo.photodb().put_many(records)
+  for (id, _), result in zip(records, results):
+    if result == sling.DBUNCHANGED: print(id, "unchanged")
+  records.clear()
+
 # Bulk load photos from batch file.
 def bulk_load(batch):
   profiles = {}
   updated = set()
-  fin = open(batch)
   num_new = 0
   num_photos = 0
+
+  # Read id, url, and nsfw fields from batch file.
+  rows = []
+  fin = open(batch, "r", buffering=1 << 20)
   for line in fin:
-    # Get id, url, and nsfw fields.
-    tab = line.find('\t')
-    if tab != -1: line = line[tab + 1:].strip()
-    line = line.strip()
-    if len(line) == 0: continue
-    fields = line.split()
-    id = fields[0]
-    url = fields[1]
+    fields = line[line.find('\t') + 1:].split()
+    if len(fields) == 0: continue
     nsfw = len(fields) >= 3 and fields[2] == "NSFW"
+    rows.append((fields[0], fields[1], nsfw))
+  fin.close()
 
-    # Get profile or create a new one.
-    profile = profiles.get(id)
-    if profile is None:
-      profile = photo.Profile(id)
-      if profile.isnew: num_new += 1
-      profiles[id] = profile
-      print("*** PROFILE %s, %d existing photos" % (id, profile.count()))
+  # Get profiles or create new ones. The profiles share the API replies, so
+  # albums and postings that occur more than once in the batch are only
+  # fetched once.
+  api_replies = {}
+  for id, _, _ in rows:
+    if id in profiles: continue
+    profile = photo.Profile(id)
+    profile.api_replies = api_replies
+    if profile.isnew: num_new += 1
+    profiles[id] = profile
+    print("*** PROFILE %s, %d existing photos" % (id, profile.count()))
+
+  # Check photos in parallel. Only urls for new photos are prefetched, since
+  # albums, galleries and postings are fetched through the APIs.
+  if flags.arg.check:
+    urls = []
+    for id, url, _ in rows:
+      kind, url = photo.classify_media(url, flags.arg.video)
+      if kind != "photo": continue
+      if profiles[id].has(url, photo.alt_url(url)): continue
+      urls.append(url)
+    photo.prefetch_heads(urls)
+
+  for id, url, nsfw in rows:
+    profile = profiles[id]
 
     # Add media to profile.
     try:
@@ -142,11 +169,10 @@ def bulk_load(batch):
       if not flags.arg.cont: raise
       print("Error processing", url, "for", id)
       traceback.print_exc(file=sys.stdout)
+  photo.head_cache.clear()
 
-  fin.close()
-
-  # Write updated profiles.
-  photo.store.coalesce()
+  # Write updated profiles to database in batches.
+  records = []
   for id in updated:
     profile = profiles[id]
     if flags.arg.dedup: profile.dedup()
@@ -154,7 +180,9 @@ def bulk_load(batch):
       print(profile.count(), "photos;", id, "not updated")
     else:
       print("Write", id, profile.count(), "photos")
-      profile.write()
+      records.append((id, profile.data()))
+      if len(records) >= write_batch_size: write_profiles(records)
+  write_profiles(records)
 
   print(len(profiles), "profiles,",
         num_new, "new,",
@@ -187,16 +215,17 @@ else:
     # Remove media matching urls.
     keep = []
     truncating = False
+    removed = set(flags.arg.url)
     for media in profile.media():
       link = profile.url(media)
 
       remove = False
       if truncating:
         remove = True
-      elif link in flags.arg.url:
+      elif link in removed:
         remove = True
       elif flags.arg.delete:
-        caption = str(media[n_legend])
+        caption = str(media[photo.n_legend])
         if caption and flags.arg.delete in caption: remove = True
 
       if remove:
@@ -223,6 +252,5 @@ else:
           profile.count(), "photos,",
           num_removed, "removed,",
           num_added, "added")
-    photo.store.coalesce()
     profile.write()
 
@@ -385,7 +385,6 @@ if flags.arg.report:
   fout.close()
 
 # Write updated profiles.
-photo.store.coalesce()
 for id in profiles:
   profiles[id].write()
 
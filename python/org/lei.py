@@ -14,8 +14,15 @@
 
 """Convert GLEIF register to SLING."""
 
-import zipfile
+import collections
 import csv
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import zipfile
+import numpy as np
 import sling
 import sling.org.bizreg
 
@@ -153,20 +160,23 @@ entity_categories = {
 bizregs = sling.org.bizreg.BusinessRegistries(kb)
 
 # Build country and region table.
-countries = {}
-regions = {}
-for item in kb:
-  code = item[n_country_code]
-  if code != None: countries[kb.resolve(code)] = item
-
-  code = item[n_region_code]
-  if code != None: regions[kb.resolve(code)] = item
+countries, regions = kb.index_by_properties(n_country_code, n_region_code)
+
+# Build table with slots for legal jurisdictions. The jurisdiction is either
+# a country code or a region code.
+jurisdictions = {}
+for code, region in regions.items():
+  slots = [(n_location_of_creation, region)]
+  country = region[n_country]
+  if country != None: slots.append((n_country, country))
+  jurisdictions[code] = slots
+for code, country in countries.items():
+  jurisdictions[code] = [(n_country, country)]
 
 # XML tags.
 x_lang = kb["xml:lang"]
 x_content = kb["is"]
 x_type = kb["type"]
-
 x_record = kb["lei:LEIRecord"]
 x_lei = kb["lei:LEI"]
 x_entity = kb["lei:Entity"]
@@ -177,7 +187,6 @@ x_transliterated_names = kb["lei:TransliteratedOtherEntityNames"]
 x_transliterated_name = kb["lei:TransliteratedOtherEntityName"]
 x_legal_address = kb["lei:LegalAddress"]
 x_headquarters_address = kb["lei:HeadquartersAddress"]
-x_legal_address = kb["lei:LegalAddress"]
 x_first_address_line = kb["lei:FirstAddressLine"]
 x_additional_address_line = kb["lei:AdditionalAddressLine"]
 x_city = kb["lei:City"]
@@ -222,16 +231,22 @@ kb.freeze()
 def closure(item, property):
   store = item.store()
   items = [item]
+  seen = {item}
   i = 0
   while i < len(items):
     f = items[i]
     i += 1
     for subitem in f(property):
       subitem = store.resolve(subitem)
-      if subitem not in items:
+      if subitem not in seen:
+        seen.add(subitem)
         items.append(subitem)
   return items
 
+# Cities and regions are shared by many companies, so the result of the city
+# lookup is cached. The regions are frames in the frozen KB, so they can be
+# used as cache keys.
+@functools.lru_cache(maxsize=200000)
 def city_in(cityname, region):
   if cityname is None: return None
   for item in aliases.lookup(cityname):
@@ -268,10 +283,12 @@ def localized_name(name):
 def get_address(store, elem):
   first_line = trim(elem[x_first_address_line])
   if first_line in cover_addresses: return None
-  addr_parts = [first_line]
+  addr_parts = []
+  if first_line: addr_parts.append(first_line)
+  prev = first_line
   for line in elem(x_additional_address_line):
     line = trim(line)
-    if line != addr_parts[-1]: addr_parts.append(line)
+    if line and line != prev: addr_parts.append(line)
     prev = line
   cityname = trim(elem[x_city])
   postal_code = elem[x_postal_code]
@@ -285,14 +302,14 @@ def get_address(store, elem):
 
   location = city
   if location == None:
-    if cityname != None and cityname != addr_parts[-1]:
+    if cityname != None and cityname != prev:
       addr_parts.append(cityname)
     location = region
   if location == None:
     location = country
     country = None
 
-  addrline = ', '.join(filter(None, addr_parts))
+  addrline = ', '.join(addr_parts)
   lang = locale(elem)
   if lang != None:
     addrline = store.qstr(addrline, store["/lang/" + lang])
@@ -326,205 +343,276 @@ def get_coord(rec, addr):
     ])
   return None
 
+# Read decompressed blocks from the first member of a zip file. Blocks are
+# decompressed in a background thread into a bounded queue of buffers, so
+# decompression of the next block overlaps with parsing of the current one.
+def read_blocks(filename, blocksize=1 << 22, depth=4):
+  blocks = queue.Queue(depth)
+
+  def reader():
+    try:
+      with zipfile.ZipFile(filename, "r") as z:
+        with z.open(z.namelist()[0], "r") as f:
+          while True:
+            block = f.read(blocksize)
+            if not block: break
+            blocks.put(block)
+    except Exception as e:
+      blocks.put(e)
+    blocks.put(None)
+
+  threading.Thread(target=reader, daemon=True).start()
+  while True:
+    block = blocks.get()
+    if block is None: break
+    if isinstance(block, Exception): raise block
+    yield block
+
+# Split blocks into XML records delimited by start and end tags. The record
+# boundaries are located with bytes.find() from the current position, and
+# the unconsumed tail is only copied once per block.
+def records(blocks, start_tag, end_tag):
+  buf = b""
+  for block in blocks:
+    buf += block
+    pos = 0
+    while True:
+      end = buf.find(end_tag, pos)
+      if end == -1: break
+      end += len(end_tag)
+      begin = buf.rfind(start_tag, pos, end)
+      if begin != -1: yield buf[begin:end]
+      pos = end
+    buf = buf[pos:]
+
+# Converted GLEIF entities for a batch of records.
+class Entities:
+  def __init__(self):
+    self.companies = []
+    self.fund_families = []
+    self.num_companies = 0
+    self.num_redirects = 0
+    self.unknown_regauth = collections.Counter()
+    self.unknown_categories = collections.Counter()
+    self.unknown_forms = collections.Counter()
+
+# Convert batch of GLEIF entity records to company frames. This runs in the
+# worker processes, so each batch is parsed into its own local store and the
+# company frames are returned in binary encoding.
+def convert_entities(batch):
+  store = sling.Store(kb)
+  result = Entities()
+  elf_forms = {}
+  for xmldata in batch:
+    # Parse XML record.
+    root = store.parse(xmldata, xml=True)
+    rec = root[x_record]
+    entity = rec[x_entity]
+    reg = rec[x_registration]
+    lei_number = rec[x_lei]
+    lei_id = "P1278/" + lei_number
+
+    # Make redirects for duplicates.
+    status = reg[x_registration_status]
+    if status == "DUPLICATE":
+      successor = entity[x_successor]
+      if successor != None:
+        redirect = successor[x_successor_lei]
+        slots = [
+          (n_id, lei_id),
+          (n_lei, lei_number),
+          (n_lei, redirect),
+        ]
+        f = store.frame(slots)
+        result.companies.append((lei_number, f.data(binary=True)))
+        result.num_redirects += 1
+      continue
+    elif status == "ANNULLED":
+      continue
+
+    # Build company frame.
+    slots = []
+    slots.append((n_id, lei_id))
+    slots.append((n_lei, lei_number))
+
+    # Organization type.
+    category = entity[x_entity_category]
+    if category != None:
+      entity_type = entity_categories.get(category)
+      if entity_type != None:
+        slots.append((n_instance_of, entity_type))
+      else:
+        result.unknown_categories[category] += 1
+    else:
+      slots.append((n_instance_of, n_organization))
+
+    # Company name.
+    legal_name = entity[x_legal_name]
+    name = localized_name(legal_name)
+    slots.append((n_name, name))
+    slots.append((n_official_name, name))
+    other_names = entity[x_other_names]
+    if other_names != None:
+      for other in other_names(x_other_name):
+        slots.append((n_name, localized_name(other)))
+    transliterated_names = entity[x_transliterated_names]
+    if transliterated_names != None:
+      for transliterated in transliterated_names(x_transliterated_name):
+        slots.append((n_name, localized_name(transliterated)))
+
+    # Address.
+    hq = entity[x_headquarters_address]
+    legal_address = entity[x_legal_address]
+    if hq != None:
+      addr = get_address(store, hq)
+      if addr != None:
+        coord = get_coord(rec, hq)
+        if coord != None: addr.append(n_coord_location, coord)
+        slots.append((n_headquarters, addr))
+    elif legal_address != None:
+      addr = get_address(store, legal_address)
+      if addr != None:
+        coord = get_coord(rec, legal_address)
+        if coord != None: addr.append(n_coord_location, coord)
+        slots.append((n_location, addr))
+
+    # Country and region for jurisdiction.
+    jurisdiction = entity[x_legal_jurisdiction]
+    if jurisdiction != None:
+      jurisdiction_slots = jurisdictions.get(jurisdiction)
+      if jurisdiction_slots != None: slots.extend(jurisdiction_slots)
+
+    # Legal form.
+    legal_form = entity[x_legal_form]
+    if legal_form != None:
+      elf = legal_form[x_legal_form_code]
+      if elf != None and elf != "8888" and elf != "9999":
+        form = elf_forms.get(elf)
+        if form is None:
+          form = store["PELF/" + elf]
+          elf_forms[elf] = form
+        slots.append((n_legal_form, form))
+      else:
+        other_form = legal_form[x_other_legal_form]
+        if other_form != None:
+          key = other_form.upper()
+          form = generic_legal_forms.get(key)
+          if form != None:
+            slots.append((n_legal_form, form))
+          elif key not in missing_legal_forms:
+            slots.append((n_legal_form, other_form))
+            result.unknown_forms[key] += 1
+
+    # Associations.
+    association = entity[x_associated_entity]
+    if association != None:
+      reltype = association[x_type]
+      if reltype == "FUND_FAMILY":
+        family_lei = association[x_associated_lei]
+        if family_lei != None and family_lei != lei_number:
+          result.fund_families.append((lei_number, family_lei))
+
+    # Expiration and mergers.
+    expiration_date = entity[x_expiration_date]
+    if expiration_date != None:
+      reason = entity[x_expiration_reason]
+      date = convert_date(expiration_date)
+      if reason == "DISSOLVED":
+        slots.append((n_dissolved, date))
+      elif reason == "CORPORATE_ACTION":
+        slots.append((n_dissolved, date))
+        successor = entity[x_successor]
+        if successor != None:
+          merged_into = successor[x_successor_lei]
+          if merged_into != None and merged_into != lei_number:
+            slots.append((n_merged_into, store["P1278/" + merged_into]))
+
+    # Company identifiers.
+    reg_auth = entity[x_registration_authority]
+    if reg_auth != None:
+      reg_auth_id = reg_auth[x_registration_authority_id]
+      entity_id = reg_auth[x_registration_authority_entity_id]
+      if (reg_auth_id != None and reg_auth_id != "RA888888" and
+          entity_id != None):
+        register = bizregs.get_regauth(reg_auth_id)
+        if register is None:
+          result.unknown_regauth[reg_auth_id] += 1
+        else:
+          ids = bizregs.companyids(register, entity_id, lei_number)
+          slots.extend(ids)
+
+    # Add source.
+    slots.append((n_described_by_source, n_gleif))
+
+    # Create item frame for company.
+    f = store.frame(slots)
+    result.companies.append((lei_number, f.data(binary=True)))
+    result.num_companies += 1
+  return result
+
+# Split items into batches.
+def batches(items, size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if len(batch) > 0: yield batch
+
 store = sling.Store(kb)
 
-def find_lei(lei):
-  company = store["P1278/" + lei]
-  if company.isproxy() or company.isglobal(): return None
-  return company
+# Company frames indexed by LEI number.
+companies = {}
+find_lei = companies.get
+
+# Start worker processes for converting entities. The workers are forked
+# after the KB and lookup tables have been loaded so they share them with the
+# main process. The fork start method is required for this.
+num_workers = os.cpu_count()
+workers = multiprocessing.get_context("fork").Pool(num_workers)
 
 # LEI company data (level 1).
 print("Reading GLEIF entities")
-lei = zipfile.ZipFile("data/c/lei/lei2.xml.zip", "r")
-leifile = lei.open(lei.namelist()[0], "r")
-
-lines = []
 num_companies = 0
 num_redirects = 0
-companies = []
-unknown_regauth = {}
-unknown_categories = {}
-unknown_forms = {}
+unknown_regauth = collections.Counter()
+unknown_categories = collections.Counter()
+unknown_forms = collections.Counter()
 fund_families = []
-for line in leifile:
-  if line.startswith(b"<lei:LEIRecord"):
-    # Start new block.
-    lines = [line]
-    continue
-  else:
-    # Add line and continue until end tag found.
-    lines.append(line)
-    if line != b"</lei:LEIRecord>\n": continue
-
-  # Parse XML record.
-  xmldata = b"".join(lines)
-  root = store.parse(xmldata, xml=True)
-  rec = root[x_record]
-  entity = rec[x_entity]
-  reg = rec[x_registration]
-  lei_number = rec[x_lei]
-  lei_id = "P1278/" + lei_number
-
-  # Make redirects for duplicates.
-  status = reg[x_registration_status]
-  if status == "DUPLICATE":
-    successor = entity[x_successor]
-    if successor != None:
-      redirect = successor[x_successor_lei]
-      slots = [
-        (n_id, lei_id),
-        (n_lei, lei_number),
-        (n_lei, redirect),
-      ]
-      f = store.frame(slots)
-      companies.append(f)
-      num_redirects += 1
-    continue
-  elif status == "ANNULLED":
-    continue
-
-  # Build company frame.
-  slots = []
-  slots.append((n_id, lei_id))
-  slots.append((n_lei, lei_number))
-
-  # Organization type.
-  category = entity[x_entity_category]
-  if category != None:
-    entity_type = entity_categories.get(category)
-    if entity_type != None:
-      slots.append((n_instance_of, entity_type))
-    else:
-      unknown_categories[category] = unknown_categories.get(category, 0) + 1
-  else:
-    slots.append((n_instance_of, n_organization))
-
-  # Company name.
-  legal_name = entity[x_legal_name]
-  name = localized_name(legal_name)
-  slots.append((n_name, name))
-  slots.append((n_official_name, name))
-  other_names = entity[x_other_names]
-  if other_names != None:
-    for other in other_names(x_other_name):
-      slots.append((n_name, localized_name(other)))
-  transliterated_names = entity[x_transliterated_names]
-  if transliterated_names != None:
-    for transliterated in transliterated_names(x_transliterated_name):
-      slots.append((n_name, localized_name(transliterated)))
-
-  # Address.
-  hq = entity[x_headquarters_address]
-  legal_address = entity[x_legal_address]
-  if hq != None:
-    addr = get_address(store, hq)
-    if addr != None:
-      coord = get_coord(rec, hq)
-      if coord != None: addr.append(n_coord_location, coord)
-      slots.append((n_headquarters, addr))
-  elif legal_address != None:
-    addr = get_address(store, legal_address)
-    if addr != None:
-      coord = get_coord(rec, legal_address)
-      if coord != None: addr.append(n_coord_location, coord)
-      slots.append((n_location, addr))
-
-  # Country and region for jurisdiction.
-  jurisdiction = entity[x_legal_jurisdiction]
-  if jurisdiction != None:
-    country = countries.get(jurisdiction)
-    if country == None:
-      region = regions.get(jurisdiction)
-      if region != None:
-        slots.append((n_location_of_creation, region))
-        country = region[n_country]
-    if country != None:
-      slots.append((n_country, country))
-
-  # Legal form.
-  legal_form = entity[x_legal_form]
-  if legal_form != None:
-    elf = legal_form[x_legal_form_code]
-    if elf != None and elf != "8888" and elf != "9999":
-      slots.append((n_legal_form, store["PELF/" + elf]))
-    else:
-      other_form = legal_form[x_other_legal_form]
-      if other_form != None:
-        key = other_form.upper()
-        form = generic_legal_forms.get(key)
-        if form != None:
-          slots.append((n_legal_form, form))
-        elif key not in missing_legal_forms:
-          slots.append((n_legal_form, other_form))
-          unknown_forms[key] = unknown_forms.get(key, 0) + 1
-
-  # Associations.
-  association = entity[x_associated_entity]
-  if association != None:
-    reltype = association[x_type]
-    if reltype == "FUND_FAMILY":
-      family_lei = association[x_associated_lei]
-      if family_lei != None and family_lei != lei_number:
-        fund_families.append((lei_number, family_lei))
-
-  # Expiration and mergers.
-  expiration_date = entity[x_expiration_date]
-  if expiration_date != None:
-    reason = entity[x_expiration_reason]
-    date = convert_date(expiration_date)
-    if reason == "DISSOLVED":
-      slots.append((n_dissolved, date))
-    elif reason == "CORPORATE_ACTION":
-      slots.append((n_dissolved, date))
-      successor = entity[x_successor]
-      if successor != None:
-        merged_into = successor[x_successor_lei]
-        if merged_into != None and merged_into != lei_number:
-          slots.append((n_merged_into, store["P1278/" + merged_into]))
-
-  # Company identifiers.
-  reg_auth = entity[x_registration_authority]
-  if reg_auth != None:
-    reg_auth_id = reg_auth[x_registration_authority_id]
-    entity_id = reg_auth[x_registration_authority_entity_id]
-    if reg_auth_id != None and reg_auth_id != "RA888888" and entity_id != None:
-      register = bizregs.get_regauth(reg_auth_id)
-      if register is None:
-        unknown_regauth[reg_auth_id] = unknown_regauth.get(reg_auth_id, 0) + 1
-      else:
-        ids = bizregs.companyids(register, entity_id, lei_number)
-        slots.extend(ids)
-
-  # Add source.
-  slots.append((n_described_by_source, n_gleif))
 
-  # Create item frame for company.
-  f = store.frame(slots)
-  companies.append(f)
-  num_companies += 1
+def add_entities(result):
+  global num_companies, num_redirects
+  for lei_number, data in result.companies:
+    companies[lei_number] = store.parse(data)
+  fund_families.extend(result.fund_families)
+  num_companies += result.num_companies
+  num_redirects += result.num_redirects
+  unknown_regauth.update(result.unknown_regauth)
+  unknown_categories.update(result.unknown_categories)
+  unknown_forms.update(result.unknown_forms)
+
+leiblocks = read_blocks("data/c/lei/lei2.xml.zip")
+leirecs = records(leiblocks, b"<lei:LEIRecord", b"</lei:LEIRecord>\n")
+pending = collections.deque()
+for batch in batches(leirecs, 1000):
+  pending.append(workers.apply_async(convert_entities, (batch,)))
+  if len(pending) > 2 * num_workers: add_entities(pending.popleft().get())
+while len(pending) > 0: add_entities(pending.popleft().get())
+workers.close()
+workers.join()
 
-leifile.close()
-lei.close()
 print(num_companies, "companies", num_redirects, "successors")
 
 # Read entity relationships (level 2).
 print("Reading GLEIF relationships")
-lines = []
-rr = zipfile.ZipFile("data/c/lei/rr.xml.zip", "r")
-rrfile = rr.open(rr.namelist()[0], "r")
-relations = []
-for line in rrfile:
-  if line.startswith(b"<rr:RelationshipRecord"):
-    # Start new block.
-    lines = [line]
-    continue
-  else:
-    # Add line and continue until end tag found.
-    lines.append(line)
-    if line != b"</rr:RelationshipRecord>\n": continue
-
+rel_parent = []
+rel_subsidiary = []
+rel_indirect = []
+rrblocks = read_blocks("data/c/lei/rr.xml.zip")
+for xmldata in records(rrblocks, b"<rr:RelationshipRecord",
+                       b"</rr:RelationshipRecord>\n"):
   # Parse XML record.
-  xmldata = b"".join(lines)
   root = store.parse(xmldata, xml=True)
 
   rec = root[x_relationship_record]
@@ -546,30 +634,38 @@ for line in rrfile:
     print("Unknown relationship:", reltype)
     continue
 
-  relations.append((end_lei, start_lei, indirect))
-
-rrfile.close()
-rr.close()
+  rel_parent.append(end_lei)
+  rel_subsidiary.append(start_lei)
+  rel_indirect.append(indirect)
+
+# Sort relationships by parent and subsidiary with direct ownership before
+# indirect ownership, and only include either direct or indirect ownership.
+rel_parent = np.array(rel_parent)
+rel_subsidiary = np.array(rel_subsidiary)
+rel_indirect = np.array(rel_indirect, dtype=bool)
+order = np.lexsort((rel_indirect, rel_subsidiary, rel_parent))
+rel_parent = rel_parent[order]
+rel_subsidiary = rel_subsidiary[order]
+rel_indirect = rel_indirect[order]
+keep = np.ones(len(order), dtype=bool)
+keep[1:] = ((rel_parent[1:] != rel_parent[:-1]) |
+            (rel_subsidiary[1:] != rel_subsidiary[:-1]))
+relations = zip(rel_parent[keep].tolist(),
+                rel_subsidiary[keep].tolist(),
+                rel_indirect[keep].tolist())
 
 # Add relationships to companies.
-relations.sort()
-prev_parent = None
-prev_subsidiary = None
 num_relations = 0
-for rel in relations:
+for parent_lei, subsidiary_lei, indirect in relations:
   # Get related organizations.
-  parent = find_lei(rel[0])
+  parent = find_lei(parent_lei)
   if parent is None:
-    print("Missing parent:", rel[0])
+    print("Missing parent:", parent_lei)
     continue
-  subsidiary = find_lei(rel[1])
+  subsidiary = find_lei(subsidiary_lei)
   if subsidiary is None:
-    print("Missing subsidiary:", rel[1])
+    print("Missing subsidiary:", subsidiary_lei)
     continue
-  indirect = rel[2]
-
-  # Only include either direct or indirect ownership.
-  if parent == prev_parent and  subsidiary == prev_subsidiary: continue
 
   # Add relationship to both parent and subsidiary.
   if indirect:
@@ -578,9 +674,6 @@ for rel in relations:
   else:
     parent.append(n_subsidiary, subsidiary)
     subsidiary.append(n_parent, parent)
-
-  prev_parent = parent
-  prev_subsidiary = subsidiary
   num_relations += 1
 
 print("Adding", len(fund_families), "fund family relationships")
@@ -617,11 +710,33 @@ for row in bicreader:
 bicfile.close()
 print(num_bic, "BIC-to-LEI mappings")
 
-# Write companies to record file.
+# Write companies to record file. The frames are serialized in the main thread
+# while a writer thread writes the records to the file.
 print("Writing companies to file")
 recout = sling.RecordWriter("data/e/org/gleif.rec")
-for company in companies:
-  recout.write(company.id, company.data(binary=True))
+output = queue.Queue(64)
+write_errors = []
+
+# Write records from queue. On errors, the queue is drained so the main
+# thread cannot block, and the error is re-raised after the writer is done.
+def write_companies():
+  while True:
+    record = output.get()
+    if record is None: break
+    if write_errors: continue
+    try:
+      recout.write(record[0], record[1])
+    except Exception as e:
+      write_errors.append(e)
+
+writer = threading.Thread(target=write_companies)
+writer.start()
+for company in companies.values():
+  if write_errors: break
+  output.put((company.id, company.data(binary=True)))
+output.put(None)
+writer.join()
+if write_errors: raise write_errors[0]
 recout.close()
 
 # Output unknown registers.
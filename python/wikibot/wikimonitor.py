@@ -15,6 +15,7 @@
 """Class defining a dashboard of the status of Sling updates to WikiData."""
 
 import pywikibot
+from pywikibot import pagegenerators
 import sling
 import sling.flags as flags
 import glob
@@ -69,11 +70,15 @@ class WikiMonitor:
     changed = 0
     redirected = 0
     updates = {}
+    ItemPage = pywikibot.ItemPage
+    WbTime = pywikibot.WbTime
+    PreloadingEntityGenerator = pagegenerators.PreloadingEntityGenerator
     for r_file in files:
       file_no += 1
-      print("Processing {:4d} of {} ({})".format(file_no, no_of_files, r_file))
+      print(f"Processing {file_no:4d} of {no_of_files} ({r_file})")
       reader = sling.RecordReader(r_file)
       last_updated = updated
+      pending = []
       for item_bytes, record in reader:
         item_str = item_bytes.decode()
         rec = rs.parse(record)
@@ -87,12 +92,22 @@ class WikiMonitor:
           continue
         updated += 1
         if flags.arg.countonly: continue
-        wd_item = pywikibot.ItemPage(self.repo, item_str)
+        pending.append((item_str, rec[self.n_facts]))
+      reader.close()
+
+      # Fetch Wikidata items for updated records in batches.
+      pages = (ItemPage(self.repo, item_str) for item_str, _ in pending)
+      items = {}
+      for wd_item in PreloadingEntityGenerator(pages, groupsize=50):
+        items[wd_item.title()] = wd_item
+
+      for item_str, facts in pending:
+        wd_item = items.get(item_str)
+        if wd_item is None: wd_item = ItemPage(self.repo, item_str)
         if wd_item.isRedirectPage():
           redirected += 1
           continue
         wd_claims = wd_item.get().get('claims')
-        facts = rec[self.n_facts]
         for prop, val in facts:
           p_claims =  wd_claims.get(str(prop), [])
           if not p_claims:
@@ -102,20 +117,19 @@ class WikiMonitor:
             if wd_claim.type == "time":
               date = sling.Date(val) # parse date from record
               precision = precision_map[date.precision] # sling to wikidata
-              target = pywikibot.WbTime(year=date.year, precision=precision)
+              target = WbTime(year=date.year, precision=precision)
               if target.toTimestr() != wd_claim.target.toTimestr():
                 print("https://www.wikidata.org/wiki/" + item_str,  str(prop))
                 print("Old:", target.toTimestr())
                 print("New:", wd_claim.target.toTimestr())
             elif wd_claim.type == 'wikibase-item':
-              target = pywikibot.ItemPage(self.repo, val)
+              target = ItemPage(self.repo, val)
             else:
               # TODO add location and possibly other types
-              print("Error: Unknown claim type", claim.type)
+              print("Error: Unknown claim type", wd_claim.type)
               continue
             if not wd_claim.target_equals(target):
               changed += 1
-      reader.close()
       print(updated - last_updated)
       f = r_file.split("-")
       date = int(f[1] + f[2] + f[3])
@@ -48,6 +48,7 @@ void PyDatabase::Define(PyObject *module) {
   methods.Add("close", &PyDatabase::Close);
   methods.AddO("get", &PyDatabase::Get);
   methods.Add("put", &PyDatabase::Put);
+  methods.Add("put_many", &PyDatabase::PutMany);
   methods.Add("add", &PyDatabase::Add);
   methods.AddO("delete", &PyDatabase::Delete);
   methods.Add("keys", &PyDatabase::Keys);
@@ -167,6 +168,50 @@ PyObject *PyDatabase::Put(PyObject *args, PyObject *kw) {
   return PyLong_FromLong(record.result);
 }
 
+PyObject *PyDatabase::PutMany(PyObject *args, PyObject *kw) {
+  // Parse arguments.
+  static const char *kwlist[] = {"records", "mode", nullptr};
+  PyObject *list = nullptr;
+  DBMode mode = DBOVERWRITE;
+  bool ok = PyArg_ParseTupleAndKeywords(
+                args, kw, "O|i", const_cast<char **>(kwlist),
+                &list, &mode);
+  if (!ok) return nullptr;
+
+  // Get keys and values for records. The record data refers to the Python
+  // objects, which are kept alive by the sequence.
+  PyObject *seq = PySequence_Fast(list, "records must be a sequence");
+  if (seq == nullptr) return nullptr;
+  Py_ssize_t size = PySequence_Fast_GET_SIZE(seq);
+  std::vector<DBRecord> records(size);
+  for (int i = 0; i < size; ++i) {
+    PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+    PyObject *key;
+    PyObject *value;
+    if (!PyArg_ParseTuple(item, "OO", &key, &value) ||
+        !GetData(key, &records[i].key) ||
+        !GetData(value, &records[i].value)) {
+      Py_DECREF(seq);
+      return nullptr;
+    }
+  }
+
+  // Update records in database.
+  Status st = Transact([&]() -> Status {
+    return db->Put(&records, mode);
+  });
+  Py_DECREF(seq);
+  if (!CheckIO(st)) return nullptr;
+
+  // Return outcomes.
+  PyObject *results = PyList_New(size);
+  if (results == nullptr) return nullptr;
+  for (int i = 0; i < size; ++i) {
+    PyList_SET_ITEM(results, i, PyLong_FromLong(records[i].result));
+  }
+  return results;
+}
+
 PyObject *PyDatabase::Add(PyObject *args, PyObject *kw) {
   // Parse arguments.
   static const char *kwlist[] = {"key", "value", "version", nullptr};
@@ -43,6 +43,9 @@ struct PyDatabase : public PyBase {
   // Put record. Return outcome.
   PyObject *Put(PyObject *args, PyObject *kw);
 
+  // Put list of (key, value) records in one request. Return list of outcomes.
+  PyObject *PutMany(PyObject *args, PyObject *kw);
+
   // Add record. Return outcome.
   PyObject *Add(PyObject *args, PyObject *kw);
 
@@ -277,16 +277,19 @@ int PyRecordWriter::Init(PyObject *args, PyObject *kwds) {
 
   // Create record writer.
   writer = new RecordWriter(f, options);
+  mu = new Mutex();
 
   return 0;
 }
 
 void PyRecordWriter::Dealloc() {
   delete writer;
+  delete mu;
   Free();
 }
 
 PyObject *PyRecordWriter::Close() {
+  MutexLock lock(mu);
   if (!CheckIO(writer->Close())) return nullptr;
   Py_RETURN_NONE;
 }
@@ -327,12 +330,21 @@ PyObject *PyRecordWriter::Write(PyObject *args) {
     }
   }
 
-  // Write record.
-  if (!CheckIO(writer->Write(key, value))) return nullptr;
+  // Write record. The GIL is released while writing, so other Python threads
+  // can run while the record is being written. The mutex serializes access
+  // to the writer instead.
+  Status st;
+  Py_BEGIN_ALLOW_THREADS;
+  mu->Lock();
+  st = writer->Write(key, value);
+  mu->Unlock();
+  Py_END_ALLOW_THREADS;
+  if (!CheckIO(st)) return nullptr;
   Py_RETURN_NONE;
 }
 
 PyObject *PyRecordWriter::Tell() {
+  MutexLock lock(mu);
   return PyLong_FromSsize_t(writer->Tell());
 }
 
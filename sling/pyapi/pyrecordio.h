@@ -17,6 +17,7 @@
 
 #include "sling/file/recordio.h"
 #include "sling/pyapi/pybase.h"
+#include "sling/util/mutex.h"
 
 namespace sling {
 
@@ -111,6 +112,9 @@ struct PyRecordWriter : public PyBase {
   // Record writer.
   RecordWriter *writer;
 
+  // Mutex for serializing access to the record writer.
+  Mutex *mu;
+
   // Registration.
   static PyTypeObject type;
   static PyMethodTable methods;
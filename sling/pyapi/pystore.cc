@@ -46,6 +46,7 @@ void PyStore::Define(PyObject *module) {
   methods.AddO("array", &PyStore::NewArray);
   methods.Add("qstr", &PyStore::NewString);
   methods.AddO("resolve", &PyStore::Resolve);
+  methods.Add("index_by_properties", &PyStore::IndexByProperties);
   methods.Add("globals", &PyStore::Globals);
   methods.Add("lockgc", &PyStore::LockGC);
   methods.Add("unlockgc", &PyStore::UnlockGC);
@@ -301,6 +302,65 @@ PyObject *PyStore::Symbols() {
   return iter->AsObject();
 }
 
+PyObject *PyStore::IndexByProperties(PyObject *args) {
+  // Get properties.
+  int num_properties = PyTuple_Size(args);
+  std::vector<Handle> properties(num_properties);
+  for (int i = 0; i < num_properties; ++i) {
+    properties[i] = RoleValue(PyTuple_GetItem(args, i), true);
+    if (properties[i].IsError()) return nullptr;
+  }
+
+  // Create index for each property.
+  PyObject *indices = PyTuple_New(num_properties);
+  if (indices == nullptr) return nullptr;
+  for (int i = 0; i < num_properties; ++i) {
+    PyObject *index = PyDict_New();
+    if (index == nullptr) {
+      Py_DECREF(indices);
+      return nullptr;
+    }
+    PyTuple_SET_ITEM(indices, i, index);
+  }
+
+  // Add frames in symbol table to indices.
+  MapDatum *symbols = store->GetMap(store->symbols());
+  for (int bucket = 0; bucket < symbols->length(); ++bucket) {
+    Handle h = symbols->get(bucket);
+    while (!h.IsNil()) {
+      SymbolDatum *symbol = store->Deref(h)->AsSymbol();
+      h = symbol->next;
+      if (!symbol->value.IsRef()) continue;
+      Datum *datum = store->Deref(symbol->value);
+      if (!datum->IsFrame()) continue;
+      FrameDatum *frame = datum->AsFrame();
+
+      for (int i = 0; i < num_properties; ++i) {
+        if (properties[i].IsNil()) continue;
+        Handle value = frame->get(properties[i]);
+        if (value.IsNil()) continue;
+
+        // Add property value to index.
+        PyObject *key = PyValue(store->Resolve(value));
+        if (key == nullptr) {
+          Py_DECREF(indices);
+          return nullptr;
+        }
+        PyObject *item = PyValue(symbol->value);
+        int rc = PyDict_SetItem(PyTuple_GET_ITEM(indices, i), key, item);
+        Py_DECREF(key);
+        Py_DECREF(item);
+        if (rc == -1) {
+          Py_DECREF(indices);
+          return nullptr;
+        }
+      }
+    }
+  }
+
+  return indices;
+}
+
 PyObject *PyStore::NewFrame(PyObject *arg) {
   // Check that store is writable.
   if (!Writable()) return nullptr;
@@ -56,6 +56,11 @@ struct PyStore : public PyBase {
   // Return iterator for all symbols in symbol table.
   PyObject *Symbols();
 
+  // Build indices for frames in symbol table by property values. Returns a
+  // tuple with a dictionary for each property mapping property values to
+  // frames.
+  PyObject *IndexByProperties(PyObject *args);
+
   // Create new frame.
   PyObject *NewFrame(PyObject *arg);
 